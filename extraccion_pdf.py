@@ -0,0 +1,197 @@
+"""
+Extracción en paralelo del texto de PDFs con muchas páginas
+Reparte las páginas de un mismo documento entre procesos de trabajo
+Autor: Sistema de análisis de facturas
+"""
+
+import io
+import os
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import pypdfium2 as pdfium
+import pdfplumber
+
+# A partir de este número de páginas compensa repartir el documento entre procesos
+MIN_PAGINAS_PARALELO = 16
+
+# Los documentos grandes se reparten entre procesos: pdfplumber está limitado por
+# el GIL y PDFium no admite llamadas concurrentes dentro de un mismo proceso (los
+# documentos pequeños se leen en el proceso de la aplicación bajo pdfium_lock).
+# El pool es único y compartido por todos los hilos que procesan archivos, de modo
+# que nunca hay más de os.cpu_count() procesos extrayendo.
+_pool_paginas = None
+_pool_lock = threading.Lock()
+
+
+def obtener_pool_paginas():
+    """
+    Devuelve el pool de procesos compartido, creándolo la primera vez
+    
+    Se usa 'spawn' porque los procesos se crean desde hilos del pool de
+    archivos, y hacer fork de un proceso con varios hilos no es seguro.
+    
+    Con 'streamlit run', sys.modules["__main__"] es el script de la aplicación,
+    así que cada proceso vuelve a ejecutar main.py como '__mp_main__' (con sus
+    imports) antes de importar este módulo. Por eso main.py solo debe hacer
+    trabajo de interfaz bajo 'if __name__ == "__main__"'. Como el pool se
+    reutiliza, ese coste se paga una vez por proceso.
+    
+    Returns:
+        ProcessPoolExecutor: Pool de procesos para extraer páginas
+    """
+    global _pool_paginas
+    with _pool_lock:
+        if _pool_paginas is None:
+            _pool_paginas = ProcessPoolExecutor(
+                max_workers=os.cpu_count(),
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool_paginas
+
+
+def descartar_pool_paginas(pool):
+    """
+    Descarta un pool roto para que la siguiente llamada cree uno nuevo
+    
+    Si otro hilo ya lo sustituyó, no se toca el pool nuevo.
+    
+    Args:
+        pool: Pool que lanzó BrokenProcessPool
+    """
+    global _pool_paginas
+    with _pool_lock:
+        if _pool_paginas is pool:
+            _pool_paginas = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+# PDFium no es thread-safe ni siquiera entre documentos distintos: toda llamada
+# a pypdfium2 dentro del proceso de la aplicación debe hacerse con este lock
+pdfium_lock = threading.Lock()
+
+
+def extraer_textos_pdfium(pdf_bytes):
+    """
+    Extrae con pypdfium2 el texto de todas las páginas de un PDF
+    
+    Los documentos pequeños se leen en este proceso bajo pdfium_lock, ya que
+    esta función se llama desde varios hilos a la vez. Los de
+    MIN_PAGINAS_PARALELO páginas o más se reparten entre el pool de procesos,
+    donde cada proceso tiene su propia copia de PDFium.
+    
+    Args:
+        pdf_bytes: Contenido completo del PDF
+        
+    Returns:
+        list: Texto de cada página, en el orden del documento
+    """
+    textos = []
+    with pdfium_lock:
+        pdf = pdfium.PdfDocument(pdf_bytes)
+        try:
+            num_paginas = len(pdf)
+            if num_paginas < MIN_PAGINAS_PARALELO:
+                for i in range(num_paginas):
+                    # Cerrar explícitamente para que ningún finalizador llame
+                    # a PDFium más tarde fuera del lock
+                    pagina = pdf[i]
+                    pagina_texto = pagina.get_textpage()
+                    textos.append(pagina_texto.get_text_range())
+                    pagina_texto.close()
+                    pagina.close()
+        finally:
+            pdf.close()
+    
+    if num_paginas >= MIN_PAGINAS_PARALELO:
+        textos = extraer_en_paralelo(extraer_paginas_pdfium, pdf_bytes, num_paginas)
+    return textos
+
+
+def extraer_paginas_pdfium(pdf_bytes, inicio, fin):
+    """
+    Extrae con pypdfium2 el texto de un rango de páginas
+    
+    Args:
+        pdf_bytes: Contenido completo del PDF
+        inicio: Índice de la primera página (incluida)
+        fin: Índice de la última página (excluida)
+        
+    Returns:
+        list: Texto de cada página del rango
+    """
+    pdf = pdfium.PdfDocument(pdf_bytes)
+    try:
+        return [pdf[i].get_textpage().get_text_range() for i in range(inicio, fin)]
+    finally:
+        pdf.close()
+
+
+def extraer_paginas_pdfplumber(pdf_bytes, inicio, fin):
+    """
+    Extrae con pdfplumber el texto de un rango de páginas
+    
+    Args:
+        pdf_bytes: Contenido completo del PDF
+        inicio: Índice de la primera página (incluida)
+        fin: Índice de la última página (excluida)
+        
+    Returns:
+        list: Texto de cada página del rango (None si la página no tiene texto)
+    """
+    with pdfplumber.open(io.BytesIO(pdf_bytes)) as pdf:
+        return [pdf.pages[i].extract_text() for i in range(inicio, fin)]
+
+
+def repartir_paginas(num_paginas, num_partes):
+    """
+    Divide las páginas en rangos contiguos de tamaño similar
+    
+    Args:
+        num_paginas: Número total de páginas del documento
+        num_partes: Número máximo de rangos
+        
+    Returns:
+        list: Tuplas (inicio, fin) que cubren todas las páginas en orden
+    """
+    num_partes = max(1, min(num_partes, num_paginas))
+    tamano, resto = divmod(num_paginas, num_partes)
+    rangos = []
+    inicio = 0
+    for parte in range(num_partes):
+        fin = inicio + tamano + (1 if parte < resto else 0)
+        rangos.append((inicio, fin))
+        inicio = fin
+    return rangos
+
+
+def extraer_en_paralelo(extractor, pdf_bytes, num_paginas):
+    """
+    Extrae el texto de todas las páginas repartiéndolas entre procesos
+    
+    Args:
+        extractor: extraer_paginas_pdfium o extraer_paginas_pdfplumber
+        pdf_bytes: Contenido completo del PDF
+        num_paginas: Número total de páginas del documento
+        
+    Returns:
+        list: Texto de cada página, en el orden del documento
+    """
+    rangos = repartir_paginas(num_paginas, os.cpu_count() or 1)
+    
+    # Si un proceso muere (p. ej. con un PDF malformado) el pool queda roto para
+    # siempre: se sustituye por uno nuevo y se reintenta una vez
+    for intento in range(2):
+        pool = obtener_pool_paginas()
+        try:
+            futures = [pool.submit(extractor, pdf_bytes, inicio, fin) for inicio, fin in rangos]
+            textos = []
+            for future in futures:
+                textos.extend(future.result())
+            return textos
+        except BrokenProcessPool:
+            descartar_pool_paginas(pool)
+            if intento == 1:
+                raise
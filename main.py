@@ -8,76 +8,223 @@ import streamlit as st
 import pdfplumber
 import PyPDF2
 import pandas as pd
+import numpy as np
 import os
+import io
+import math
 import json
 import re
+import hashlib
+import tempfile
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from itertools import islice
 from openai import OpenAI
 
-# Configuración de la página
-st.set_page_config(
-    page_title="Analizador de Facturas PDF",
-    page_icon="📊",
-    layout="wide"
+# orjson es opcional: parsea las respuestas de OpenAI bastante más rápido
+try:
+    import orjson
+    cargar_json = orjson.loads
+except ImportError:
+    cargar_json = json.loads
+
+from extraccion_pdf import (
+    MIN_PAGINAS_PARALELO,
+    extraer_en_paralelo,
+    extraer_paginas_pdfplumber,
+    extraer_textos_pdfium,
 )
+from resumen_numba import CATEGORIAS_TIPO, sumar_por_tipo
+
+# Configuración de la página. Los procesos de extraccion_pdf reejecutan este
+# script como '__mp_main__', y ahí no hay interfaz que configurar
+if __name__ == "__main__":
+    st.set_page_config(
+        page_title="Analizador de Facturas PDF",
+        page_icon="📊",
+        layout="wide"
+    )
+
+# Los patrones se compilan a nivel de módulo y no dentro de los bucles. Streamlit
+# reejecuta este script en cada interacción, pero la caché interna de re evita
+# recompilarlos
+# Importe con dos decimales (p. ej. "1.234,56" o "99.00"), usado para detectar tablas
+PATRON_IMPORTE = re.compile(r"\d+[.,]\d{2}\b")
+# Líneas con varios importes a partir de las cuales se considera la factura una tabla
+MIN_IMPORTES_FILA_TABLA = 3
+MIN_FILAS_TABLA = 3
+
 
-def extraer_texto_pdf(archivo_pdf):
+def es_factura_con_tablas(texto):
     """
-    Extrae el texto de un archivo PDF usando pdfplumber (principal)
-    con fallback a PyPDF2 si falla
+    Detecta si el texto extraído proviene de una factura con muchas tablas
+    
+    Cuenta las líneas con varios importes, típicas de las filas de conceptos
+    con cantidad, precio e importe. En esas facturas pdfplumber agrupa mejor
+    las celdas que pypdfium2.
     
     Args:
-        archivo_pdf: Objeto de archivo PDF subido
+        texto: Texto extraído del PDF
+        
+    Returns:
+        bool: True si hay suficientes filas con aspecto de tabla
+    """
+    filas_tabla = 0
+    for linea in texto.splitlines():
+        # Basta con encontrar MIN_IMPORTES_FILA_TABLA importes; no hace falta recorrer toda la línea
+        importes = islice(PATRON_IMPORTE.finditer(linea), MIN_IMPORTES_FILA_TABLA)
+        if sum(1 for _ in importes) >= MIN_IMPORTES_FILA_TABLA:
+            filas_tabla += 1
+            if filas_tabla >= MIN_FILAS_TABLA:
+                return True
+    return False
+
+
+def extraer_texto_documento(pdf_bytes, avisos):
+    """
+    Extrae el texto de un PDF usando pypdfium2 (principal),
+    pdfplumber si falla o la factura tiene muchas tablas, y PyPDF2
+    como último recurso
+    
+    Args:
+        pdf_bytes: Contenido completo del PDF
+        avisos: Lista donde se acumulan los mensajes (nivel, texto) para la UI
         
     Returns:
         str: Texto extraído del PDF
     """
-    texto_completo = ""
+    archivo_pdf = io.BytesIO(pdf_bytes)
+    texto_pdfium = ""
     
     try:
-        # Método principal: pdfplumber (mejor para facturas con tablas)
+        # Método principal: pypdfium2 (el más rápido y con menos memoria)
+        texto_pdfium = "\n".join(extraer_textos_pdfium(pdf_bytes))
+        
+        if texto_pdfium.strip() and not es_factura_con_tablas(texto_pdfium):
+            return texto_pdfium
+    except Exception as e:
+        avisos.append(("warning", f"pypdfium2 falló, intentando con pdfplumber: {str(e)}"))
+    
+    partes = []
+    
+    try:
+        # Primer fallback: pdfplumber (mejor para facturas con tablas)
+        archivo_pdf.seek(0)  # Resetear el puntero del archivo
         with pdfplumber.open(archivo_pdf) as pdf:
-            for pagina in pdf.pages:
-                texto = pagina.extract_text()
-                if texto:
-                    texto_completo += texto + "\n"
+            num_paginas = len(pdf.pages)
+            if num_paginas >= MIN_PAGINAS_PARALELO:
+                textos = extraer_en_paralelo(extraer_paginas_pdfplumber, pdf_bytes, num_paginas)
+            else:
+                textos = [pagina.extract_text() for pagina in pdf.pages]
+        
+        partes.extend(texto for texto in textos if texto)
         
-        if texto_completo.strip():
-            return texto_completo
+        if any(parte.strip() for parte in partes):
+            return "\n".join(partes)
     except Exception as e:
-        st.warning(f"pdfplumber falló, intentando con PyPDF2: {str(e)}")
+        avisos.append(("warning", f"pdfplumber falló, intentando con PyPDF2: {str(e)}"))
+    
+    # Factura con tablas que pdfplumber no pudo leer: vale el texto de pypdfium2
+    if texto_pdfium.strip():
+        return texto_pdfium
     
     try:
-        # Fallback: PyPDF2
+        # Último recurso: PyPDF2
         archivo_pdf.seek(0)  # Resetear el puntero del archivo
         lector_pdf = PyPDF2.PdfReader(archivo_pdf)
         for pagina in lector_pdf.pages:
             texto = pagina.extract_text()
             if texto:
-                texto_completo += texto + "\n"
+                partes.append(texto)
     except Exception as e:
-        st.error(f"Error al extraer texto con PyPDF2: {str(e)}")
+        avisos.append(("error", f"Error al extraer texto con PyPDF2: {str(e)}"))
         return None
     
-    return texto_completo if texto_completo.strip() else None
+    return "\n".join(partes) if any(parte.strip() for parte in partes) else None
 
 
-def analizar_factura_con_openai(texto_pdf, nombre_archivo):
+class ExtraccionIncompleta(Exception):
     """
-    Utiliza OpenAI GPT-5 para extraer datos estructurados de la factura
+    Extracción fallida o que tuvo que recurrir a un método alternativo
+    
+    Se lanza desde extraer_texto_bytes para que st.cache_data, que no memoriza
+    excepciones, solo guarde las extracciones correctas.
     
     Args:
-        texto_pdf: Texto extraído del PDF
-        nombre_archivo: Nombre del archivo para contexto
+        texto: Texto obtenido pese a todo, o None
+        avisos: Avisos generados durante la extracción
+    """
+    
+    def __init__(self, texto, avisos):
+        super().__init__("extracción incompleta")
+        self.texto = texto
+        self.avisos = avisos
+
+
+@st.cache_data(max_entries=128, show_spinner=False)
+def extraer_texto_bytes(pdf_bytes):
+    """
+    Versión memorizada de extraer_texto_documento, indexada por el contenido
+    del PDF: volver a procesar los mismos archivos no vuelve a parsearlos
+    
+    Solo se memorizan las extracciones sin avisos. Si no hubo texto o hubo que
+    recurrir a otro método (p. ej. por un error transitorio), se lanza
+    ExtraccionIncompleta y se reintentará en la próxima ejecución.
+    
+    Args:
+        pdf_bytes: Contenido completo del PDF
         
     Returns:
-        dict: Datos estructurados de la factura
+        str: Texto extraído
     """
-    prompt = f"""
-Analiza el siguiente texto extraído de una factura PDF y extrae TODOS los datos disponibles.
-Devuelve un JSON con la siguiente estructura exacta:
+    avisos = []
+    texto = extraer_texto_documento(pdf_bytes, avisos)
+    if texto is None or avisos:
+        raise ExtraccionIncompleta(texto, avisos)
+    return texto
+
 
-{{
+def extraer_texto_pdf(archivo_pdf, avisos):
+    """
+    Extrae el texto de un archivo PDF subido, reutilizando la extracción
+    previa si ya se procesó un archivo con el mismo contenido
+    
+    Args:
+        archivo_pdf: Objeto de archivo PDF subido
+        avisos: Lista donde se acumulan los mensajes (nivel, texto) para la UI
+        
+    Returns:
+        str: Texto extraído del PDF
+    """
+    try:
+        return extraer_texto_bytes(archivo_pdf.getvalue())
+    except ExtraccionIncompleta as e:
+        avisos.extend(e.avisos)
+        return e.texto
+
+
+# Facturas por petición a OpenAI y límite de texto por lote para no exceder el contexto
+TAMANO_LOTE = 6
+MAX_CARACTERES_LOTE = 60000
+# Usar GPT-5 (el modelo más reciente de OpenAI lanzado el 7 de agosto de 2025)
+# No cambiar a modelos antiguos a menos que el usuario lo solicite explícitamente
+MODELO_OPENAI = "gpt-5"
+# Tokens de respuesta reservados por factura. En GPT-5 incluyen también los de
+# razonamiento, así que se deja margen de sobra para el JSON (unos 500 tokens)
+MAX_TOKENS_POR_FACTURA = 2048
+
+# Instrucciones fijas de análisis. Al no depender de la factura, forman un prefijo
+# idéntico en todas las peticiones y OpenAI puede cachearlo (prompt caching)
+PROMPT_SISTEMA = """Eres un experto contador que extrae datos de facturas con precisión. Respondes únicamente con JSON válido.
+
+Analiza los textos extraídos de facturas PDF que te envíe el usuario y extrae TODOS los datos disponibles de cada una.
+Recibirás un array JSON donde cada elemento tiene "id", "archivo" y "texto".
+Devuelve un JSON con la clave "facturas": un array con un objeto por cada factura recibida,
+en el mismo orden, con la siguiente estructura exacta:
+
+{
+    "id": el mismo id de la factura recibida,
     "numero_factura": "número de factura si existe, o null",
     "fecha": "fecha en formato YYYY-MM-DD si existe, o null",
     "proveedor_cliente": "nombre del proveedor o cliente",
@@ -90,7 +237,7 @@ Devuelve un JSON con la siguiente estructura exacta:
     "total": número decimal o null,
     "conceptos": "breve descripción de productos/servicios",
     "observaciones": "cualquier dato adicional relevante"
-}}
+}
 
 IMPORTANTE:
 - Extrae SOLO los datos que realmente existan en el texto
@@ -98,22 +245,162 @@ IMPORTANTE:
 - Los números deben ser decimales sin símbolos de moneda
 - La fecha debe estar en formato YYYY-MM-DD
 - Para determinar tipo (ingreso/gasto): analiza si la factura es emitida por nosotros (ingreso) o recibida de un proveedor (gasto)
+- No mezcles datos entre facturas distintas
 
-Texto de la factura:
-{texto_pdf}
+Responde ÚNICAMENTE con el JSON, sin texto adicional."""
 
-Responde ÚNICAMENTE con el JSON, sin texto adicional.
-"""
+# Caché en disco de respuestas de OpenAI, indexada por el hash del texto extraído.
+# Cada combinación de modelo y prompt usa su propio subdirectorio, de modo que al
+# cambiar cualquiera de los dos no se reutilizan análisis hechos con el anterior
+VERSION_CACHE = hashlib.blake2b(f"{MODELO_OPENAI}\n{PROMPT_SISTEMA}".encode("utf-8"), digest_size=8).hexdigest()
+RAIZ_CACHE = os.path.join(".cache", "invoices")
+DIRECTORIO_CACHE = os.path.join(RAIZ_CACHE, VERSION_CACHE)
+# Número máximo de facturas guardadas; al superarlo se eliminan las más antiguas
+MAX_FACTURAS_CACHE = 1000
+
+
+def factura_con_error(nombre_archivo, mensaje):
+    """
+    Construye la estructura básica de una factura que no se pudo analizar
+    
+    Args:
+        nombre_archivo: Nombre del archivo de la factura
+        mensaje: Descripción del error
+        
+    Returns:
+        dict: Datos de la factura con valores por defecto
+    """
+    return {
+        "nombre_archivo": nombre_archivo,
+        "numero_factura": None,
+        "fecha": None,
+        "proveedor_cliente": "Error al procesar",
+        "tipo": "gasto",
+        "base_imponible": 0.0,
+        "iva": 0.0,
+        "porcentaje_iva": 0.0,
+        "irpf": 0.0,
+        "porcentaje_irpf": 0.0,
+        "total": 0.0,
+        "conceptos": "",
+        "observaciones": f"Error: {mensaje}"
+    }
+
+
+def hash_texto(texto_pdf):
+    """
+    Calcula la clave de caché de una factura a partir de su texto extraído
+    
+    Args:
+        texto_pdf: Texto extraído del PDF
+        
+    Returns:
+        str: Hash BLAKE2b en hexadecimal
+    """
+    return hashlib.blake2b(texto_pdf.encode("utf-8")).hexdigest()
+
+
+def buscar_factura_en_cache(clave):
+    """
+    Busca en la caché los datos de una factura con el mismo texto
+    
+    Se lee siempre de disco (un JSON pequeño por factura), sin memoria
+    intermedia, para respetar la versión de la caché y lo que elimine
+    recortar_cache.
+    
+    Args:
+        clave: Hash del texto de la factura, calculado con hash_texto
+        
+    Returns:
+        dict: Datos estructurados de la factura, o None si no está en caché
+    """
+    try:
+        with open(os.path.join(DIRECTORIO_CACHE, f"{clave}.json"), "rb") as f:
+            return cargar_json(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def guardar_factura_en_cache(clave, datos_factura):
+    """
+    Guarda en disco los datos de una factura analizada con éxito
+    
+    La escritura es atómica (fichero temporal + os.replace) para que una
+    lectura concurrente nunca vea un JSON a medias.
+    
+    Args:
+        clave: Hash del texto de la factura, calculado con hash_texto
+        datos_factura: Datos estructurados devueltos por OpenAI
+    """
+    os.makedirs(DIRECTORIO_CACHE, exist_ok=True)
+    descriptor, ruta_temporal = tempfile.mkstemp(dir=DIRECTORIO_CACHE, suffix=".tmp")
+    try:
+        with os.fdopen(descriptor, "w", encoding="utf-8") as f:
+            json.dump(datos_factura, f, ensure_ascii=False)
+        os.replace(ruta_temporal, os.path.join(DIRECTORIO_CACHE, f"{clave}.json"))
+    except BaseException:
+        os.remove(ruta_temporal)
+        raise
+
+
+def recortar_cache():
+    """
+    Limita el tamaño de la caché en disco
+    
+    Elimina los subdirectorios de versiones anteriores del modelo o del prompt
+    y, si quedan más de MAX_FACTURAS_CACHE facturas, las escritas hace más tiempo.
+    """
+    if not os.path.isdir(RAIZ_CACHE):
+        return
+    
+    for nombre in os.listdir(RAIZ_CACHE):
+        ruta = os.path.join(RAIZ_CACHE, nombre)
+        if nombre != VERSION_CACHE and os.path.isdir(ruta):
+            shutil.rmtree(ruta, ignore_errors=True)
+    
+    if not os.path.isdir(DIRECTORIO_CACHE):
+        return
+    
+    entradas = [e for e in os.scandir(DIRECTORIO_CACHE) if e.name.endswith(".json")]
+    if len(entradas) <= MAX_FACTURAS_CACHE:
+        return
+    
+    entradas.sort(key=lambda e: e.stat().st_mtime)
+    for entrada in entradas[:len(entradas) - MAX_FACTURAS_CACHE]:
+        try:
+            os.remove(entrada.path)
+        except OSError:
+            pass
+
+
+def analizar_facturas_batch(lotes, avisos):
+    """
+    Utiliza OpenAI GPT-5 para extraer datos estructurados de varias facturas
+    en una sola petición, amortizando la latencia de red y el prompt de sistema
+    
+    Args:
+        lotes: Lista de tuplas (nombre_archivo, texto_pdf, clave de caché)
+        avisos: Lista donde se acumulan los mensajes (nivel, texto) para la UI
+        
+    Returns:
+        list: Datos estructurados de cada factura, en el mismo orden que lotes
+    """
+    facturas_entrada = [
+        {"id": i, "archivo": nombre_archivo, "texto": texto_pdf}
+        for i, (nombre_archivo, texto_pdf, _) in enumerate(lotes)
+    ]
+    
+    # Solo la parte variable va en el mensaje de usuario; las instrucciones
+    # fijas están en PROMPT_SISTEMA para que OpenAI reutilice su prefijo cacheado
+    prompt = f"Facturas:\n{json.dumps(facturas_entrada, ensure_ascii=False)}"
     
     try:
-        # Usar GPT-5 (el modelo más reciente de OpenAI lanzado el 7 de agosto de 2025)
-        # No cambiar a modelos antiguos a menos que el usuario lo solicite explícitamente
         response = openai_client.chat.completions.create(
-            model="gpt-5",
+            model=MODELO_OPENAI,
             messages=[
                 {
                     "role": "system",
-                    "content": "Eres un experto contador que extrae datos de facturas con precisión. Respondes únicamente con JSON válido."
+                    "content": PROMPT_SISTEMA
                 },
                 {
                     "role": "user",
@@ -121,58 +408,210 @@ Responde ÚNICAMENTE con el JSON, sin texto adicional.
                 }
             ],
             response_format={"type": "json_object"},
-            max_completion_tokens=2048
+            max_completion_tokens=MAX_TOKENS_POR_FACTURA * len(lotes)
         )
         
-        # Parsear respuesta JSON
-        datos_factura = json.loads(response.choices[0].message.content)
-        datos_factura["nombre_archivo"] = nombre_archivo
+        if response.choices[0].finish_reason == "length":
+            raise ValueError("la respuesta superó el límite de tokens y llegó incompleta")
         
-        return datos_factura
+        # Parsear respuesta JSON y emparejar cada resultado con su factura por id
+        respuesta = cargar_json(response.choices[0].message.content)
+        # El modelo puede devolver el id como cadena ("0"): se normaliza a int
+        por_id = {}
+        for factura in respuesta.get("facturas", []):
+            if not isinstance(factura, dict):
+                continue
+            try:
+                por_id[int(factura.get("id"))] = factura
+            except (TypeError, ValueError):
+                continue
         
     except Exception as e:
-        st.error(f"Error al analizar con OpenAI: {str(e)}")
+        avisos.append(("error", f"Error al analizar con OpenAI: {str(e)}"))
         # Retornar estructura básica en caso de error
-        return {
-            "nombre_archivo": nombre_archivo,
-            "numero_factura": None,
-            "fecha": None,
-            "proveedor_cliente": "Error al procesar",
-            "tipo": "gasto",
-            "base_imponible": 0.0,
-            "iva": 0.0,
-            "porcentaje_iva": 0.0,
-            "irpf": 0.0,
-            "porcentaje_irpf": 0.0,
-            "total": 0.0,
-            "conceptos": "",
-            "observaciones": f"Error: {str(e)}"
-        }
+        return [factura_con_error(nombre_archivo, str(e)) for nombre_archivo, _, _ in lotes]
+    
+    resultados = []
+    for i, (nombre_archivo, _, clave) in enumerate(lotes):
+        datos_factura = por_id.get(i)
+        if datos_factura is None:
+            mensaje = "la respuesta de OpenAI no incluye esta factura"
+            avisos.append(("error", f"Error al analizar {nombre_archivo}: {mensaje}"))
+            datos_factura = factura_con_error(nombre_archivo, mensaje)
+        else:
+            datos_factura.pop("id", None)
+            datos_factura["nombre_archivo"] = nombre_archivo
+            # Solo se cachean los análisis correctos; los errores se reintentan
+            try:
+                guardar_factura_en_cache(clave, datos_factura)
+            except OSError as e:
+                avisos.append(("warning", f"No se pudo guardar {nombre_archivo} en caché: {str(e)}"))
+        resultados.append(datos_factura)
+    
+    return resultados
 
 
-def procesar_factura(archivo_pdf):
+def agrupar_en_lotes(facturas):
     """
-    Procesa un archivo PDF completo: extracción + análisis
+    Agrupa las facturas extraídas en lotes para enviarlas juntas a OpenAI
+    
+    Cada lote tiene como máximo TAMANO_LOTE facturas y MAX_CARACTERES_LOTE
+    caracteres de texto (salvo que una sola factura ya lo supere).
+    
+    Args:
+        facturas: Lista de tuplas (indice, nombre_archivo, texto_pdf, clave de caché)
+        
+    Returns:
+        list: Lista de lotes, cada uno una lista de tuplas como las de entrada
+    """
+    lotes = []
+    lote_actual = []
+    caracteres = 0
+    
+    for factura in facturas:
+        longitud = len(factura[2])
+        if lote_actual and (len(lote_actual) >= TAMANO_LOTE or caracteres + longitud > MAX_CARACTERES_LOTE):
+            lotes.append(lote_actual)
+            lote_actual = []
+            caracteres = 0
+        lote_actual.append(factura)
+        caracteres += longitud
+    
+    if lote_actual:
+        lotes.append(lote_actual)
+    
+    return lotes
+
+
+def extraer_factura(archivo_pdf):
+    """
+    Extrae el texto de un archivo PDF subido
+    
+    Se ejecuta en un hilo del pool de trabajo, por lo que no escribe
+    directamente en la interfaz de Streamlit: los mensajes se devuelven
+    para que el hilo principal los muestre.
     
     Args:
         archivo_pdf: Objeto de archivo PDF subido
         
     Returns:
-        dict: Datos estructurados de la factura o None si falla
+        tuple: (texto extraído o None si falla, lista de avisos)
     """
-    nombre_archivo = archivo_pdf.name
+    avisos = []
     
-    with st.spinner(f"📄 Extrayendo texto de {nombre_archivo}..."):
-        texto = extraer_texto_pdf(archivo_pdf)
+    texto = extraer_texto_pdf(archivo_pdf, avisos)
     
     if not texto:
-        st.error(f"❌ No se pudo extraer texto de {nombre_archivo}")
-        return None
+        avisos.append(("error", f"❌ No se pudo extraer texto de {archivo_pdf.name}"))
+    
+    return texto, avisos
+
+
+def analizar_lote(lote):
+    """
+    Analiza un lote de facturas ya extraídas con una sola petición a OpenAI
+    
+    Se ejecuta en un hilo del pool de trabajo, igual que extraer_factura.
+    
+    Args:
+        lote: Lista de tuplas (indice, nombre_archivo, texto_pdf, clave de caché)
+        
+    Returns:
+        tuple: (lista de datos de factura en el orden del lote, lista de avisos)
+    """
+    avisos = []
+    datos = analizar_facturas_batch([(nombre, texto, clave) for _, nombre, texto, clave in lote], avisos)
+    return datos, avisos
+
+
+def mostrar_avisos(avisos):
+    """
+    Muestra en la interfaz los mensajes acumulados durante el procesamiento
+    
+    Args:
+        avisos: Lista de tuplas (nivel, texto), con nivel 'warning' o 'error'
+    """
+    for nivel, texto in avisos:
+        getattr(st, nivel)(texto)
+
+
+# Columnas de las facturas procesadas, guardadas en la sesión como listas por columna
+CAMPOS_FACTURA = [
+    'nombre_archivo', 'numero_factura', 'fecha', 'proveedor_cliente', 'tipo',
+    'base_imponible', 'iva', 'porcentaje_iva', 'irpf', 'porcentaje_irpf', 'total',
+    'conceptos', 'observaciones'
+]
+CAMPOS_NUMERICOS = {'base_imponible', 'iva', 'porcentaje_iva', 'irpf', 'porcentaje_irpf', 'total'}
+
+
+def nuevas_columnas_facturas():
+    """
+    Crea el almacén vacío de facturas procesadas, con una lista por columna
     
-    with st.spinner(f"🤖 Analizando factura {nombre_archivo} con IA..."):
-        datos = analizar_factura_con_openai(texto, nombre_archivo)
+    Returns:
+        dict: Lista vacía por cada campo de CAMPOS_FACTURA
+    """
+    return {campo: [] for campo in CAMPOS_FACTURA}
+
+
+def convertir_a_float(valor):
+    """
+    Convierte un importe devuelto por OpenAI a float, usando 0.0 si no es numérico
     
-    return datos
+    Args:
+        valor: Valor del campo (número, cadena o None)
+        
+    Returns:
+        float: Importe como decimal
+    """
+    try:
+        numero = float(valor)
+    except (TypeError, ValueError):
+        return 0.0
+    return 0.0 if math.isnan(numero) else numero
+
+
+def agregar_factura(columnas, datos_factura):
+    """
+    Añade una factura al almacén por columnas, con los importes ya como float
+    
+    Así el DataFrame se construye directamente con los tipos correctos y no
+    hace falta convertir las columnas numéricas en cada recarga.
+    
+    Args:
+        columnas: Almacén creado con nuevas_columnas_facturas
+        datos_factura: Datos estructurados de la factura
+    """
+    for campo in CAMPOS_FACTURA:
+        valor = datos_factura.get(campo)
+        columnas[campo].append(convertir_a_float(valor) if campo in CAMPOS_NUMERICOS else valor)
+
+
+def actualizar_progreso(progress_bar, pasos, pasos_totales, porcentaje_mostrado):
+    """
+    Actualiza la barra de progreso solo cuando se cruza un nuevo 1%
+    
+    Cada llamada a progress_bar.progress provoca un mensaje a la interfaz,
+    así que con muchos archivos se limita a unas 100 actualizaciones.
+    
+    Args:
+        progress_bar: Barra de progreso de Streamlit
+        pasos: Pasos completados hasta ahora
+        pasos_totales: Pasos totales del proceso
+        porcentaje_mostrado: Último porcentaje mostrado en la barra
+        
+    Returns:
+        int: Porcentaje que muestra la barra tras la llamada
+    """
+    porcentaje = pasos * 100 // pasos_totales
+    if porcentaje > porcentaje_mostrado:
+        progress_bar.progress(porcentaje)
+        return porcentaje
+    return porcentaje_mostrado
+
+
+# A partir de este número de facturas el resumen se calcula con numba (si está instalado)
+MIN_FACTURAS_NUMBA = 100000
 
 
 def calcular_resumen_financiero(facturas_df):
@@ -185,23 +624,42 @@ def calcular_resumen_financiero(facturas_df):
     Returns:
         dict: Resumen financiero completo
     """
-    # Separar ingresos y gastos
-    ingresos = facturas_df[facturas_df['tipo'] == 'ingreso']
-    gastos = facturas_df[facturas_df['tipo'] == 'gasto']
+    if sumar_por_tipo is not None and len(facturas_df) >= MIN_FACTURAS_NUMBA:
+        # Volúmenes grandes: el tipo se codifica una vez como int8 y un único
+        # kernel paralelo recorre las columnas numéricas en una sola pasada
+        codigos_tipo = pd.Categorical(facturas_df['tipo'], categories=CATEGORIAS_TIPO).codes
+        sumas = sumar_por_tipo(
+            facturas_df['total'].to_numpy(dtype=np.float64),
+            facturas_df['iva'].to_numpy(dtype=np.float64),
+            facturas_df['irpf'].to_numpy(dtype=np.float64),
+            codigos_tipo
+        )
+        ingresos = dict(zip(['total', 'iva', 'irpf', 'n'], sumas[:4]))
+        gastos = dict(zip(['total', 'iva', 'irpf', 'n'], sumas[4:]))
+    else:
+        # Agregar ingresos y gastos en una sola pasada; un tipo sin facturas queda a 0
+        agregado = facturas_df.groupby('tipo', sort=False).agg(
+            total=('total', 'sum'),
+            iva=('iva', 'sum'),
+            irpf=('irpf', 'sum'),
+            n=('total', 'size')
+        ).reindex(['ingreso', 'gasto'], fill_value=0)
+        ingresos = agregado.loc['ingreso']
+        gastos = agregado.loc['gasto']
     
     # Calcular totales
-    total_ingresos = ingresos['total'].sum()
-    total_gastos = gastos['total'].sum()
+    total_ingresos = ingresos['total']
+    total_gastos = gastos['total']
     beneficio = total_ingresos - total_gastos
     
     # IVA: en ingresos es repercutido (cobrado), en gastos es soportado (pagado)
-    iva_repercutido = ingresos['iva'].sum()
-    iva_soportado = gastos['iva'].sum()
+    iva_repercutido = ingresos['iva']
+    iva_soportado = gastos['iva']
     balance_iva = iva_repercutido - iva_soportado
     
     # IRPF: en ingresos es retenido (restado), en gastos es aplicado
-    irpf_total_ingresos = ingresos['irpf'].sum()
-    irpf_total_gastos = gastos['irpf'].sum()
+    irpf_total_ingresos = ingresos['irpf']
+    irpf_total_gastos = gastos['irpf']
     
     return {
         'total_ingresos': total_ingresos,
@@ -212,8 +670,8 @@ def calcular_resumen_financiero(facturas_df):
         'balance_iva': balance_iva,
         'irpf_ingresos': irpf_total_ingresos,
         'irpf_gastos': irpf_total_gastos,
-        'num_ingresos': len(ingresos),
-        'num_gastos': len(gastos)
+        'num_ingresos': int(ingresos['n']),
+        'num_gastos': int(gastos['n'])
     }
 
 
@@ -316,8 +774,8 @@ def main():
     """)
     
     # Inicializar estado de sesión
-    if 'facturas_procesadas' not in st.session_state:
-        st.session_state.facturas_procesadas = []
+    if 'facturas_cols' not in st.session_state:
+        st.session_state.facturas_cols = nuevas_columnas_facturas()
     
     # Sección de carga de archivos
     st.subheader("📁 Subir Facturas PDF")
@@ -337,43 +795,108 @@ def main():
     
     with col2:
         if st.button("🗑️ Limpiar Todo", use_container_width=True):
-            st.session_state.facturas_procesadas = []
+            st.session_state.facturas_cols = nuevas_columnas_facturas()
             st.rerun()
     
     # Procesar archivos cuando se presiona el botón
     if procesar_btn and archivos_pdf:
-        st.session_state.facturas_procesadas = []  # Limpiar datos previos
+        st.session_state.facturas_cols = nuevas_columnas_facturas()  # Limpiar datos previos
         
         progress_bar = st.progress(0)
         total_archivos = len(archivos_pdf)
+        resultados = [None] * total_archivos
+        # Cada archivo avanza la barra dos veces: al extraer y al analizar
+        pasos_totales = 2 * total_archivos
+        pasos = 0
+        porcentaje_mostrado = 0
+        
+        # Extracción y llamada a OpenAI son I/O, así que se solapan entre archivos.
+        # Streamlit no es thread-safe: la UI solo se actualiza desde este hilo.
+        with st.spinner(f"🤖 Procesando {total_archivos} facturas..."):
+            with ThreadPoolExecutor(max_workers=min(8, total_archivos)) as ex:
+                # Fase 1: extraer el texto de todos los PDFs
+                futures = {ex.submit(extraer_factura, archivo): idx for idx, archivo in enumerate(archivos_pdf)}
+                extraidas = []
+                
+                for future in as_completed(futures):
+                    idx = futures[future]
+                    nombre_archivo = archivos_pdf[idx].name
+                    texto, avisos = future.result()
+                    
+                    # Actualizar barra de progreso
+                    pasos += 1 if texto else 2
+                    porcentaje_mostrado = actualizar_progreso(progress_bar, pasos, pasos_totales, porcentaje_mostrado)
+                    mostrar_avisos(avisos)
+                    
+                    if texto:
+                        extraidas.append((idx, nombre_archivo, texto))
+                    else:
+                        st.error(f"❌ Error al procesar {nombre_archivo}")
+                
+                # Fase 2: agrupar las facturas con texto idéntico para analizar
+                # cada una una sola vez y repartir luego el resultado a sus copias
+                extraidas.sort()
+                unicas = []
+                copias = {}
+                
+                for idx, nombre_archivo, texto in extraidas:
+                    clave = hash_texto(texto)
+                    if clave in copias:
+                        copias[clave].append((idx, nombre_archivo))
+                    else:
+                        copias[clave] = []
+                        unicas.append((idx, nombre_archivo, texto, clave))
+                
+                # Fase 3: servir desde caché las facturas ya analizadas
+                pendientes = []
+                
+                for idx, nombre_archivo, texto, clave in unicas:
+                    datos_factura = buscar_factura_en_cache(clave)
+                    if datos_factura is None:
+                        pendientes.append((idx, nombre_archivo, texto, clave))
+                        continue
+                    
+                    for idx_copia, nombre_copia in [(idx, nombre_archivo)] + copias[clave]:
+                        resultados[idx_copia] = {**datos_factura, "nombre_archivo": nombre_copia}
+                        pasos += 1
+                        porcentaje_mostrado = actualizar_progreso(progress_bar, pasos, pasos_totales, porcentaje_mostrado)
+                        st.success(f"✅ {nombre_copia} procesado correctamente (desde caché)")
+                
+                # Fase 4: analizar el resto de facturas en lotes con OpenAI
+                futures = {ex.submit(analizar_lote, lote): lote for lote in agrupar_en_lotes(pendientes)}
+                
+                for future in as_completed(futures):
+                    lote = futures[future]
+                    datos_lote, avisos = future.result()
+                    mostrar_avisos(avisos)
+                    
+                    for (idx, nombre_archivo, _, clave), datos_factura in zip(lote, datos_lote):
+                        for idx_copia, nombre_copia in [(idx, nombre_archivo)] + copias[clave]:
+                            resultados[idx_copia] = {**datos_factura, "nombre_archivo": nombre_copia}
+                            pasos += 1
+                            st.success(f"✅ {nombre_copia} procesado correctamente")
+                    
+                    # Actualizar barra de progreso
+                    porcentaje_mostrado = actualizar_progreso(progress_bar, pasos, pasos_totales, porcentaje_mostrado)
         
-        for idx, archivo in enumerate(archivos_pdf):
-            # Actualizar barra de progreso
-            progress_bar.progress((idx + 1) / total_archivos)
-            
-            # Procesar factura
-            datos_factura = procesar_factura(archivo)
-            
+        # Mantener el orden de subida en la tabla de resultados
+        for datos_factura in resultados:
             if datos_factura:
-                st.session_state.facturas_procesadas.append(datos_factura)
-                st.success(f"✅ {archivo.name} procesado correctamente")
-            else:
-                st.error(f"❌ Error al procesar {archivo.name}")
+                agregar_factura(st.session_state.facturas_cols, datos_factura)
+        
+        # Mantener acotada la caché con los análisis guardados en esta ejecución
+        recortar_cache()
         
         progress_bar.empty()
-        st.success(f"🎉 ¡Proceso completado! {len(st.session_state.facturas_procesadas)} facturas procesadas.")
+        st.success(f"🎉 ¡Proceso completado! {len(st.session_state.facturas_cols['nombre_archivo'])} facturas procesadas.")
     
     # Mostrar resultados si hay facturas procesadas
-    if st.session_state.facturas_procesadas:
+    if st.session_state.facturas_cols['nombre_archivo']:
         st.divider()
         
         # Convertir a DataFrame para mejor visualización
-        df_facturas = pd.DataFrame(st.session_state.facturas_procesadas)
-        
-        # Asegurar que los campos numéricos sean float
-        campos_numericos = ['base_imponible', 'iva', 'porcentaje_iva', 'irpf', 'porcentaje_irpf', 'total']
-        for campo in campos_numericos:
-            df_facturas[campo] = pd.to_numeric(df_facturas[campo], errors='coerce').fillna(0.0)
+        # Los campos numéricos ya se guardaron como float al añadir cada factura
+        df_facturas = pd.DataFrame(st.session_state.facturas_cols, copy=False)
         
         # Mostrar resumen financiero
         resumen = calcular_resumen_financiero(df_facturas)
@@ -384,22 +907,24 @@ def main():
         # Tabla detallada de facturas
         st.header("📋 Detalle de Facturas Procesadas")
         
-        # Preparar DataFrame para visualización
-        df_display = df_facturas[[
-            'nombre_archivo', 'numero_factura', 'fecha', 'proveedor_cliente', 
-            'tipo', 'base_imponible', 'iva', 'irpf', 'total', 'conceptos'
-        ]].copy()
-        
-        # Renombrar columnas para mejor lectura
-        df_display.columns = [
-            'Archivo', 'Nº Factura', 'Fecha', 'Proveedor/Cliente', 
-            'Tipo', 'Base Imponible (€)', 'IVA (€)', 'IRPF (€)', 'Total (€)', 'Conceptos'
-        ]
+        # Columnas a mostrar con su nombre para mejor lectura
+        columnas_display = {
+            'nombre_archivo': 'Archivo', 'numero_factura': 'Nº Factura', 'fecha': 'Fecha',
+            'proveedor_cliente': 'Proveedor/Cliente', 'tipo': 'Tipo',
+            'base_imponible': 'Base Imponible (€)', 'iva': 'IVA (€)', 'irpf': 'IRPF (€)',
+            'total': 'Total (€)', 'conceptos': 'Conceptos'
+        }
+        columnas_euro = ['base_imponible', 'iva', 'irpf', 'total']
         
-        # Formatear números
-        columnas_euro = ['Base Imponible (€)', 'IVA (€)', 'IRPF (€)', 'Total (€)']
-        for col in columnas_euro:
-            df_display[col] = df_display[col].apply(lambda x: f"{x:.2f}")
+        # Preparar DataFrame para visualización reutilizando las columnas de
+        # df_facturas sin copiarlo; solo los importes formateados son datos nuevos
+        datos_display = {}
+        for campo, titulo in columnas_display.items():
+            if campo in columnas_euro:
+                datos_display[titulo] = np.char.mod('%.2f', df_facturas[campo].to_numpy(dtype=float))
+            else:
+                datos_display[titulo] = df_facturas[campo]
+        df_display = pd.DataFrame(datos_display, copy=False)
         
         # Mostrar tabla con estilo
         st.dataframe(
@@ -413,7 +938,10 @@ def main():
         st.subheader("💾 Exportar Datos")
         
         # Convertir a CSV
-        csv = df_display.to_csv(index=False).encode('utf-8')
+        # Escribir directamente en bytes para no materializar el CSV dos veces
+        buffer_csv = io.BytesIO()
+        df_display.to_csv(buffer_csv, index=False, encoding='utf-8')
+        csv = buffer_csv.getvalue()
         
         st.download_button(
             label="📥 Descargar Resumen en CSV",
@@ -438,8 +966,14 @@ def main():
     
     # Footer
     st.divider()
-    st.caption("🔒 Tus datos se procesan de forma segura. Los PDFs no se almacenan permanentemente.")
+    st.caption(
+        "🔒 Tus datos se procesan de forma segura. Los PDFs no se almacenan permanentemente, "
+        "pero los datos extraídos de cada factura se guardan en una caché local del servidor "
+        f"(máximo {MAX_FACTURAS_CACHE} facturas, compartida entre sesiones) para no volver a analizarlas."
+    )
 
 
+# Imprescindible: los procesos 'spawn' de extraccion_pdf importan este script
+# como '__mp_main__' y no deben volver a ejecutar la aplicación
 if __name__ == "__main__":
     main()
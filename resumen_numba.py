@@ -0,0 +1,52 @@
+"""
+Reducciones aceleradas con numba para volúmenes muy grandes de facturas
+Se mantienen fuera del script de Streamlit, que se reejecuta en cada interacción,
+para que el kernel se compile una sola vez y quede guardado en disco (cache=True)
+Autor: Sistema de análisis de facturas
+"""
+
+# numba es opcional: solo compensa su compilación con volúmenes muy grandes de facturas
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# Códigos de tipo que recibe sumar_por_tipo (los de pd.Categorical con
+# categories=CATEGORIAS_TIPO; cualquier otro valor queda como -1)
+CATEGORIAS_TIPO = ['ingreso', 'gasto']
+CODIGO_INGRESO = 0
+CODIGO_GASTO = 1
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def sumar_por_tipo(totales, ivas, irpfs, codigos_tipo):
+        """
+        Suma totales, IVA, IRPF y número de facturas de ingresos y gastos
+        en una sola pasada sobre las columnas
+        
+        Args:
+            totales: Array float64 con el total de cada factura
+            ivas: Array float64 con el IVA de cada factura
+            irpfs: Array float64 con el IRPF de cada factura
+            codigos_tipo: Array int8 con CODIGO_INGRESO, CODIGO_GASTO u otro valor
+            
+        Returns:
+            tuple: (total, iva, irpf, n) de ingresos seguido de los de gastos
+        """
+        total_ing = iva_ing = irpf_ing = 0.0
+        total_gas = iva_gas = irpf_gas = 0.0
+        n_ing = n_gas = 0
+        for i in prange(totales.shape[0]):
+            if codigos_tipo[i] == CODIGO_INGRESO:
+                total_ing += totales[i]
+                iva_ing += ivas[i]
+                irpf_ing += irpfs[i]
+                n_ing += 1
+            elif codigos_tipo[i] == CODIGO_GASTO:
+                total_gas += totales[i]
+                iva_gas += ivas[i]
+                irpf_gas += irpfs[i]
+                n_gas += 1
+        return total_ing, iva_ing, irpf_ing, n_ing, total_gas, iva_gas, irpf_gas, n_gas
+else:
+    sumar_por_tipo = None